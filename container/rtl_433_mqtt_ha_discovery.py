@@ -1,10 +1,16 @@
 import paho.mqtt.client as mqtt
+import argparse
 import certifi
 import os
+import sys
 import time
 import json
 import logging
+import random
 import re
+import resource
+import signal
+from dataclasses import dataclass, field, replace
 
 
 # For additional documentation see basis for this file at:
@@ -20,16 +26,48 @@ log_handler.setFormatter(log_formatter)
 logger.addHandler(log_handler)
 
 
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, settings, flags, rc):
     if rc == 0:
-        logger.info("MQTT: Connected to broker.")
-        logger.info(f"MQTT: Subscribe: {RTL_433_MQTT_TOPIC}")
-        client.subscribe(RTL_433_MQTT_TOPIC)
+        connection_state["attempts"] = 0
+        connection_stats["connects"] += 1
+        logger.info(
+            f"MQTT: Connected to broker (connects: {connection_stats['connects']}, disconnects: {connection_stats['disconnects']})."
+        )
+        if connection_stats["connects"] == 1:
+            log_startup()
+        else:
+            resync_discovery(settings)
+        subscribe(client, settings)
     else:
+        connection_stats["connect_failures"] += 1
         logger.error(f"MQTT: Failed to connect, rc: {rc}")
 
 
-def on_message(client, userdata, msg):
+def on_disconnect(client, settings, rc):
+    connection_stats["disconnects"] += 1
+    connection_state["attempts"] = max(connection_state["attempts"], 1)
+    if rc != 0:
+        logger.warning(
+            f"MQTT: Unexpected disconnect, rc: {rc} (disconnects: {connection_stats['disconnects']})"
+        )
+
+
+def on_subscribe(client, settings, mid, granted_qos):
+    # A granted QoS of 128 is the broker refusing the subscription
+    if 128 in granted_qos:
+        subscribe_failed(settings, "refused by broker")
+    else:
+        connection_state["subscribe_attempts"] = 0
+
+
+def on_publish(client, settings, mid):
+    if mid not in pending_publishes:
+        early_acks.add(mid)
+        return
+    discovery_publish_acked(settings, mid)
+
+
+def on_message(client, settings, msg):
     logger.debug(f"MQTT: Message received: f{str(msg.payload.decode('utf-8'))}")
     logger.debug(
         f"MQTT: Message topic: {msg.topic}, qos: {msg.qos}, retain flag: {msg.retain}"
@@ -40,7 +78,7 @@ def on_message(client, userdata, msg):
 
         topicprefix = "/".join(msg.topic.split("/", 2)[:2])
         topicprefix = "rtl_433"
-        bridge_event_to_hass(client, topicprefix, data)
+        bridge_event_to_hass(client, settings, topicprefix, data)
 
     except json.decoder.JSONDecodeError:
         logger.error("JSON decode error: " + msg.payload.decode("utf-8"))
@@ -48,33 +86,203 @@ def on_message(client, userdata, msg):
 
 BOOL_TRUES = ["true", "yes", "1"]
 
-RTL_433_RETAIN = os.getenv("RTL_433_RETAIN", "false").lower() in BOOL_TRUES
-RTL_433_FORCE_UPDATE = os.getenv("RTL_433_FORCE_UPDATE", "false").lower() in BOOL_TRUES
-RTL_433_MQTT_TOPIC = os.getenv(
-    "RTL_433_MQTT_TOPIC",
-    "rtl_433/+/events",
-)
-RTL_433_DEVICE_TOPIC_SUFFIX = os.getenv(
-    "RTL_433_DEVICE_TOPIC_SUFFIX",
-    "devices[/type][/model][/subtype][/channel][/id]",
-)
-RTL_433_INTERVAL = int(os.getenv("RTL_433_INTERVAL", 600))
-RTL_433_EXPIRE_AFTER = int(os.getenv("RTL_433_EXPIRE_AFTER", 0))
-RTL_433_IDS = os.getenv("RTL_433_IDS", "").split(",")
-
-MQTT_BROKER = os.getenv("MQTT_BROKER", default="mqtt")
-MQTT_PORT = os.getenv("MQTT_PORT", default=8883)
-MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID", default=f"rtl_433-mqtt-ha-discovery")
-MQTT_USERNAME = os.getenv("MQTT_USERNAME", default=None)
-MQTT_PASSWORD = os.getenv("MQTT_PASSWORD", default=None)
 
-HA_DISCOVERY_PREFIX = os.getenv("HA_DISCOVERY_PREFIX", "homeassistant")
+def env_bool(environ, name, default="false"):
+    return environ.get(name, default).lower() in BOOL_TRUES
+
+
+@dataclass
+class Settings:
+    """Runtime configuration, see the README for details on each setting."""
+
+    rtl_433_retain: bool = False
+    rtl_433_force_update: bool = False
+    rtl_433_mqtt_topic: str = "rtl_433/+/events"
+    rtl_433_device_topic_suffix: str = "devices[/type][/model][/subtype][/channel][/id]"
+    rtl_433_interval: int = 600
+    rtl_433_expire_after: int = 0
+    rtl_433_ids: list = field(default_factory=list)
+    rtl_433_abbreviate: bool = False
+    rtl_433_profile_sample: float = 0.0
+    rtl_433_report_interval: int = 3600
+    rtl_433_stale_after: int = 0
+    rtl_433_gc_interval: int = 300
+    rtl_433_forget_after: int = 86400
+    rtl_433_inventory_file: str = None
+    rtl_433_retry_min: int = 5
+    rtl_433_retry_max: int = 300
+    rtl_433_resync: str = "spread"
+    rtl_433_resync_window: int = 60
+
+    mqtt_broker: str = "mqtt"
+    mqtt_port: int = 8883
+    mqtt_client_id: str = "rtl_433-mqtt-ha-discovery"
+    mqtt_username: str = None
+    mqtt_password: str = None
+    mqtt_max_inflight: int = 20
+    mqtt_max_queued: int = 1000
+    mqtt_reconnect_min: int = 1
+    mqtt_reconnect_max: int = 120
+
+    ha_discovery_prefix: str = "homeassistant"
+    ha_discovery_qos: int = 0
+
+    log_level: int = logging.INFO
+
+    # Derived lookup tables, built once from the settings above
+    topic_segments: list = field(init=False, repr=False)
+    mappings: dict = field(init=False, repr=False)
+
+    def __post_init__(self):
+        if self.rtl_433_resync not in RESYNC_POLICIES:
+            raise Exception(f"RTL_433_RESYNC must be one of: {RESYNC_POLICIES}")
+
+        self.topic_segments = compile_topic_suffix(self.rtl_433_device_topic_suffix)
+        self.mappings = compile_mappings(self)
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        return cls(
+            rtl_433_retain=env_bool(environ, "RTL_433_RETAIN"),
+            rtl_433_force_update=env_bool(environ, "RTL_433_FORCE_UPDATE"),
+            rtl_433_mqtt_topic=environ.get(
+                "RTL_433_MQTT_TOPIC", cls.rtl_433_mqtt_topic
+            ),
+            rtl_433_device_topic_suffix=environ.get(
+                "RTL_433_DEVICE_TOPIC_SUFFIX", cls.rtl_433_device_topic_suffix
+            ),
+            rtl_433_interval=int(environ.get("RTL_433_INTERVAL", cls.rtl_433_interval)),
+            rtl_433_expire_after=int(
+                environ.get("RTL_433_EXPIRE_AFTER", cls.rtl_433_expire_after)
+            ),
+            rtl_433_ids=[i for i in environ.get("RTL_433_IDS", "").split(",") if i],
+            rtl_433_abbreviate=env_bool(environ, "RTL_433_ABBREVIATE"),
+            rtl_433_profile_sample=float(
+                environ.get("RTL_433_PROFILE_SAMPLE", cls.rtl_433_profile_sample)
+            ),
+            rtl_433_report_interval=int(
+                environ.get("RTL_433_REPORT_INTERVAL", cls.rtl_433_report_interval)
+            ),
+            rtl_433_stale_after=int(
+                environ.get("RTL_433_STALE_AFTER", cls.rtl_433_stale_after)
+            ),
+            rtl_433_gc_interval=int(
+                environ.get("RTL_433_GC_INTERVAL", cls.rtl_433_gc_interval)
+            ),
+            rtl_433_forget_after=int(
+                environ.get("RTL_433_FORGET_AFTER", cls.rtl_433_forget_after)
+            ),
+            rtl_433_inventory_file=environ.get("RTL_433_INVENTORY_FILE"),
+            rtl_433_retry_min=int(
+                environ.get("RTL_433_RETRY_MIN", cls.rtl_433_retry_min)
+            ),
+            rtl_433_retry_max=int(
+                environ.get("RTL_433_RETRY_MAX", cls.rtl_433_retry_max)
+            ),
+            rtl_433_resync=environ.get("RTL_433_RESYNC", cls.rtl_433_resync).lower(),
+            rtl_433_resync_window=int(
+                environ.get("RTL_433_RESYNC_WINDOW", cls.rtl_433_resync_window)
+            ),
+            mqtt_broker=environ.get("MQTT_BROKER", cls.mqtt_broker),
+            mqtt_port=int(environ.get("MQTT_PORT", cls.mqtt_port)),
+            mqtt_client_id=environ.get("MQTT_CLIENT_ID", cls.mqtt_client_id),
+            mqtt_username=environ.get("MQTT_USERNAME"),
+            mqtt_password=environ.get("MQTT_PASSWORD"),
+            mqtt_max_inflight=int(
+                environ.get("MQTT_MAX_INFLIGHT", cls.mqtt_max_inflight)
+            ),
+            mqtt_max_queued=int(environ.get("MQTT_MAX_QUEUED", cls.mqtt_max_queued)),
+            mqtt_reconnect_min=int(
+                environ.get("MQTT_RECONNECT_MIN", cls.mqtt_reconnect_min)
+            ),
+            mqtt_reconnect_max=int(
+                environ.get("MQTT_RECONNECT_MAX", cls.mqtt_reconnect_max)
+            ),
+            ha_discovery_prefix=environ.get(
+                "HA_DISCOVERY_PREFIX", cls.ha_discovery_prefix
+            ),
+            ha_discovery_qos=int(environ.get("HA_DISCOVERY_QOS", cls.ha_discovery_qos)),
+            log_level=int(environ.get("LOG_LEVEL", cls.log_level)),
+        )
 
-LOG_LEVEL = int(os.getenv("LOG_LEVEL", default=logging.INFO))
-logger.setLevel(LOG_LEVEL)
 
 discovery_timeouts = {}
 
+# Discovery publishes held by the client until the broker acknowledges them,
+# a topic is not published again while it is in here.  A QoS 0 publish is
+# "acknowledged" once it has been written to the socket.
+pending_publishes = {}  # mid -> discovery topic
+pending_topics = {}  # discovery topic -> mid
+# on_publish can fire before client.publish() has returned the mid
+early_acks = set()
+# Consecutive failed publishes per discovery topic, drives the retry backoff
+publish_failures = {}
+
+# How to re-announce known devices after reconnecting to the broker:
+#   none   - leave discovery deadlines alone, wait out RTL_433_INTERVAL
+#   all    - re-announce every device on its next event
+#   spread - re-announce on the next event after a random delay within
+#            RTL_433_RESYNC_WINDOW, so the broker isn't hit all at once
+RESYNC_POLICIES = ["none", "all", "spread"]
+
+connection_stats = {
+    "connects": 0,
+    "disconnects": 0,
+    "connect_failures": 0,
+    "subscribe_failures": 0,
+}
+# Backoff bookkeeping for the connection lifecycle, see maintain_connection()
+connection_state = {
+    "attempts": 0,
+    "subscribe_attempts": 0,
+    "subscribe_at": None,
+    # When run() started, for the startup report on first connect
+    "started_at": None,
+}
+
+# Per model event statistics, reported by log_report().  Counts are always
+# kept; stage timings only for the RTL_433_PROFILE_SAMPLE fraction of events.
+# Both tables are bounded, overflow is folded into a REPORT_OTHER entry.
+MAX_REPORT_MODELS = 256
+MAX_REPORT_FIELDS = 32
+REPORT_OTHER = "(other)"
+
+model_stats = {}
+# model -> {field: count} of fields that have no mapping
+unmapped_fields = {}
+
+report_state = {
+    "requested": False,
+    "next_at": None,
+    "gc_at": None,
+}
+
+
+class DeviceRecord:
+    """What is known about a device that has been heard from.  Slotted, with
+    model names and field sets shared between devices, as there can be
+    thousands of these."""
+
+    __slots__ = ("model", "fields", "first_seen", "last_seen", "events", "interval")
+
+    def __init__(self, model, fields, now):
+        self.model = model
+        self.fields = fields
+        self.first_seen = now
+        self.last_seen = now
+        self.events = 1
+        # Smoothed seconds between events, None until a second event arrives
+        self.interval = None
+
+
+# device id -> DeviceRecord
+device_inventory = {}
+# Interned field sets, most devices of a model report the same fields
+field_sets = {}
+# Stale devices whose configs are being cleared:
+#   device id -> (connects when published, [MQTTMessageInfo])
+pending_clears = {}
+
 # Fields that get ignored when publishing to Home Assistant
 # (reduces noise to help spot missing field mappings)
 SKIP_KEYS = [
@@ -633,6 +841,38 @@ secret_knock_mappings = [
     },
 ]
 
+# Subset of the Home Assistant MQTT discovery key abbreviations, covering the
+# keys this script emits.  Kept inline to avoid installing homeassistant just
+# for the lookup tables.
+# https://www.home-assistant.io/integrations/mqtt/#discovery-payload
+ABBREVIATIONS = {
+    "automation_type": "atype",
+    "device": "dev",
+    "device_class": "dev_cla",
+    "enabled_by_default": "en",
+    "entity_category": "ent_cat",
+    "expire_after": "exp_aft",
+    "force_update": "frc_upd",
+    "icon": "ic",
+    "payload": "pl",
+    "payload_off": "pl_off",
+    "payload_on": "pl_on",
+    "platform": "p",
+    "state_class": "stat_cla",
+    "state_topic": "stat_t",
+    "subtype": "stype",
+    "topic": "t",
+    "unique_id": "uniq_id",
+    "unit_of_measurement": "unit_of_meas",
+    "value_template": "val_tpl",
+}
+
+DEVICE_ABBREVIATIONS = {
+    "identifiers": "ids",
+    "manufacturer": "mf",
+    "model": "mdl",
+}
+
 TOPIC_PARSE_RE = re.compile(
     r"\[(?P<slash>/?)(?P<token>[^\]:]+):?(?P<default>[^\]:]*)\]"
 )
@@ -643,37 +883,138 @@ def sanitize(text):
     return text.replace(" ", "_").replace("/", "_").replace(".", "_").replace("&", "")
 
 
-def rtl_433_device_info(data, topic_prefix):
+def compile_topic_suffix(topic_suffix):
+    """Split an rtl_433 device topic pattern into (literal, slash, token, default)
+    segments so events don't have to re-parse it."""
+    segments = []
+    last_match_end = 0
+    for match in re.finditer(TOPIC_PARSE_RE, topic_suffix):
+        segments.append(
+            (
+                topic_suffix[last_match_end : match.start()],
+                match.group(1),
+                match.group(2),
+                match.group(3),
+            )
+        )
+        last_match_end = match.end()
+    return segments
+
+
+def compile_mappings(settings):
+    """Return mappings keyed by rtl_433 field with the settings wide config
+    options (force_update, expire_after) already applied."""
+    compiled = {}
+    for key, mapping in mappings.items():
+        compiled[key] = [compile_mapping(settings, mapping)]
+    compiled["secret_knock"] = [
+        compile_mapping(settings, m) for m in secret_knock_mappings
+    ]
+    return compiled
+
+
+def compile_mapping(settings, mapping):
+    config = mapping["config"].copy()
+
+    if settings.rtl_433_force_update:
+        config["force_update"] = "true"
+
+    if settings.rtl_433_expire_after > 0:
+        config["expire_after"] = settings.rtl_433_expire_after
+
+    return dict(mapping, config=config)
+
+
+def rtl_433_device_info(settings, data, topic_prefix):
     """Return rtl_433 device topic to subscribe to for a data element, based on the
     rtl_433 device topic argument, as well as the device identifier"""
 
     path_elements = []
     id_elements = []
-    last_match_end = 0
     # The default for RTL_433_DEVICE_TOPIC_SUFFIX is the same topic structure
     # as set by default in rtl433 config
-    for match in re.finditer(TOPIC_PARSE_RE, RTL_433_DEVICE_TOPIC_SUFFIX):
-        path_elements.append(
-            RTL_433_DEVICE_TOPIC_SUFFIX[last_match_end : match.start()]
-        )
-        key = match.group(2)
+    for literal, slash, key, default in settings.topic_segments:
+        path_elements.append(literal)
         if key in data:
             # If we have this key, prepend a slash if needed
-            if match.group(1):
+            if slash:
                 path_elements.append("/")
             element = sanitize(str(data[key]))
             path_elements.append(element)
             id_elements.append(element)
-        elif match.group(3):
-            path_elements.append(match.group(3))
-        last_match_end = match.end()
+        elif default:
+            path_elements.append(default)
 
     path = "".join(list(filter(lambda item: item, path_elements)))
     id = "-".join(id_elements)
     return (f"{topic_prefix}/{path}", id)
 
 
-def publish_config(client, topic, model, object_id, mapping, key=None):
+def abbreviate_config(config):
+    """Return a copy of a discovery config using abbreviated key names."""
+    abbreviated = {}
+    for key, value in config.items():
+        if key == "device":
+            value = {DEVICE_ABBREVIATIONS.get(k, k): v for k, v in value.items()}
+        abbreviated[ABBREVIATIONS.get(key, key)] = value
+    return abbreviated
+
+
+def backoff(minimum, maximum, attempts):
+    """Exponential backoff delay, doubling from minimum up to maximum."""
+    return min(maximum, minimum * 2 ** (attempts - 1))
+
+
+def jitter(delay):
+    """Randomize a delay to between half and all of its value."""
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_delay(settings, failures):
+    """Exponential backoff for a discovery topic after a number of failures."""
+    return backoff(settings.rtl_433_retry_min, settings.rtl_433_retry_max, failures)
+
+
+def discovery_publish_acked(settings, mid):
+    """Commit the discovery deadline once the broker has the config."""
+    discovery_topic = pending_publishes.pop(mid)
+    del pending_topics[discovery_topic]
+    publish_failures.pop(discovery_topic, None)
+    discovery_timeouts[discovery_topic] = time.time() + settings.rtl_433_interval
+    logger.debug(f"MQTT: Discovery acknowledged, mid: {mid}, topic: {discovery_topic}")
+
+
+def discovery_publish_failed(settings, discovery_topic, now):
+    failures = publish_failures.get(discovery_topic, 0) + 1
+    publish_failures[discovery_topic] = failures
+    delay = retry_delay(settings, failures)
+    discovery_timeouts[discovery_topic] = now + delay
+    return delay
+
+
+def add_timing(timings, stage, start):
+    """Accumulate the time since start against a stage, if being sampled."""
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def config_topic(settings, mapping, object_id):
+    """Return the Home Assistant discovery topic for a mapping of a device."""
+    object_name = "-".join([object_id, mapping["object_suffix"]])
+    return "/".join(
+        [
+            settings.ha_discovery_prefix,
+            mapping["device_type"],
+            object_id,
+            object_name,
+            "config",
+        ]
+    )
+
+
+def publish_config(
+    client, settings, topic, model, object_id, mapping, key=None, timings=None
+):
     """Publish Home Assistant auto discovery data."""
     global discovery_timeouts
 
@@ -681,9 +1022,7 @@ def publish_config(client, topic, model, object_id, mapping, key=None):
     object_suffix = mapping["object_suffix"]
     object_name = "-".join([object_id, object_suffix])
 
-    discovery_topic = "/".join(
-        [HA_DISCOVERY_PREFIX, device_type, object_id, object_name, "config"]
-    )
+    discovery_topic = config_topic(settings, mapping, object_id)
 
     # check timeout
     now = time.time()
@@ -692,8 +1031,14 @@ def publish_config(client, topic, model, object_id, mapping, key=None):
             logger.debug(f"Discovery timeout in the future for: {discovery_topic}")
             return False
 
-    discovery_timeouts[discovery_topic] = now + RTL_433_INTERVAL
+    # The client still holds the last publish and will deliver it, sending
+    # again would only queue a duplicate behind it.  The deadline is set to
+    # the full interval once the broker acknowledges it.
+    if discovery_topic in pending_topics:
+        logger.debug(f"Discovery awaiting acknowledgement for: {discovery_topic}")
+        return False
 
+    start = time.perf_counter()
     config = mapping["config"].copy()
 
     # Device Automation configuration is in a different structure compared to
@@ -717,29 +1062,53 @@ def publish_config(client, topic, model, object_id, mapping, key=None):
         "manufacturer": "rtl_433",
     }
 
-    if RTL_433_FORCE_UPDATE:
-        config["force_update"] = "true"
+    if settings.rtl_433_abbreviate:
+        payload = json.dumps(
+            abbreviate_config(config), separators=(",", ":"), ensure_ascii=False
+        )
+    else:
+        payload = json.dumps(config)
 
-    if RTL_433_EXPIRE_AFTER > 0:
-        config["expire_after"] = RTL_433_EXPIRE_AFTER
+    add_timing(timings, "config", start)
 
     logger.debug(
-        f"discovery_topic={discovery_topic}, retain={RTL_433_RETAIN}, data={json.dumps(config)}"
+        f"discovery_topic={discovery_topic}, retain={settings.rtl_433_retain}, data={payload}"
     )
 
+    start = time.perf_counter()
     (result, mid) = client.publish(
-        discovery_topic, json.dumps(config), retain=RTL_433_RETAIN
+        discovery_topic,
+        payload,
+        qos=settings.ha_discovery_qos,
+        retain=settings.rtl_433_retain,
     )
-    if result != 0:
+    add_timing(timings, "publish", start)
+    # QoS 1/2 publishes made while disconnected are queued and sent on
+    # reconnect, only QoS 0 ones are lost
+    queued = result == mqtt.MQTT_ERR_NO_CONN and settings.ha_discovery_qos > 0
+    if result != 0 and not queued:
+        delay = discovery_publish_failed(settings, discovery_topic, now)
         logger.error(
-            f"MQTT: Error publishing discovery, result: {result}, topic: {discovery_topic}"
+            f"MQTT: Error publishing discovery, result: {result}, topic: {discovery_topic}, retry in: {delay}s"
         )
         return False
 
+    # Message ids wrap, forget any stale publish that still holds this one
+    stale_topic = pending_publishes.get(mid)
+    if stale_topic is not None:
+        del pending_topics[stale_topic]
+
+    pending_publishes[mid] = discovery_topic
+    pending_topics[discovery_topic] = mid
+    if mid in early_acks:
+        discovery_publish_acked(settings, mid)
+    # Anything else in here is an ack for a publish that isn't tracked
+    early_acks.clear()
+
     return True
 
 
-def bridge_event_to_hass(client, topic_prefix, data):
+def bridge_event_to_hass(client, settings, topic_prefix, data):
     """Translate some rtl_433 sensor data to Home Assistant auto discovery."""
 
     if "model" not in data:
@@ -751,7 +1120,17 @@ def bridge_event_to_hass(client, topic_prefix, data):
     skipped_keys = []
     published_keys = []
 
-    base_topic, device_id = rtl_433_device_info(data, topic_prefix)
+    timings = None
+    if settings.rtl_433_profile_sample > 0:
+        if random.random() < settings.rtl_433_profile_sample:
+            timings = {}
+    event_start = time.perf_counter()
+
+    stats = record_event(model)
+
+    start = time.perf_counter()
+    base_topic, device_id = rtl_433_device_info(settings, data, topic_prefix)
+    add_timing(timings, "device_info", start)
     if not device_id:
         # no unique device identifier
         logger.warning(f"No suitable identifier found for model: {model}")
@@ -759,62 +1138,628 @@ def bridge_event_to_hass(client, topic_prefix, data):
 
     data_id = str(data.get("id", None))
 
-    if len(RTL_433_IDS) > 0 and data_id not in RTL_433_IDS:
+    if settings.rtl_433_ids and data_id not in settings.rtl_433_ids:
         logger.debug(f"Device ({data_id}) is not in the desired list of device ids.")
         return
 
+    record_device(settings, device_id, model, data)
+
     # detect known attributes
     for key in data.keys():
-        if key in mappings:
+        if key in settings.mappings:
             topic = "/".join([base_topic, key])
-            if publish_config(client, topic, model, device_id, mappings[key], key):
-                published_keys.append(key)
+            for m in settings.mappings[key]:
+                if publish_config(
+                    client, settings, topic, model, device_id, m, key, timings
+                ):
+                    published_keys.append(key)
         else:
             if key not in SKIP_KEYS:
                 skipped_keys.append(key)
 
-    if "secret_knock" in data.keys():
-        for m in secret_knock_mappings:
-            topic = "/".join([base_topic, "secret_knock"])
-            if publish_config(client, topic, model, device_id, m, "secret_knock"):
-                published_keys.append("secret_knock")
+    stats["published"] += len(published_keys)
+    stats["skipped"] += len(skipped_keys)
+    record_unmapped(model, skipped_keys)
+    add_timing(timings, "total", event_start)
+    if timings is not None:
+        # Only events that made it this far count as samples, the stage
+        # averages are taken over these
+        stats["sampled"] += 1
+        for stage, elapsed in timings.items():
+            stats["time"][stage] = stats["time"].get(stage, 0.0) + elapsed
 
     if published_keys:
         logger.info(f"Published {device_id}: {published_keys}")
 
-        if skipped_keys:
-            logger.info(f"Skipped {device_id}: {skipped_keys}")
 
+def record_event(model):
+    """Count an event against its model, returning the model's stats entry."""
+    if model not in model_stats and len(model_stats) >= MAX_REPORT_MODELS:
+        model = REPORT_OTHER
+    stats = model_stats.get(model)
+    if stats is None:
+        stats = {"events": 0, "sampled": 0, "published": 0, "skipped": 0, "time": {}}
+        model_stats[model] = stats
+    stats["events"] += 1
+    return stats
 
-def run():
-    if MQTT_BROKER is None:
+
+def record_unmapped(model, keys):
+    if not keys:
+        return
+    if model not in unmapped_fields and len(unmapped_fields) >= MAX_REPORT_MODELS:
+        model = REPORT_OTHER
+    fields = unmapped_fields.setdefault(model, {})
+    for key in keys:
+        if key not in fields and len(fields) >= MAX_REPORT_FIELDS:
+            key = REPORT_OTHER
+        fields[key] = fields.get(key, 0) + 1
+
+
+def record_device(settings, device_id, model, data):
+    """Note a device as seen in the inventory."""
+    now = time.time()
+    fields = frozenset(key for key in data if key in settings.mappings)
+    fields = field_sets.setdefault(fields, fields)
+
+    # Heard from again while being cleared, it will be re-announced
+    pending_clears.pop(device_id, None)
+
+    record = device_inventory.get(device_id)
+    if record is None:
+        device_inventory[device_id] = DeviceRecord(sys.intern(model), fields, now)
+        return
+
+    elapsed = now - record.last_seen
+    if record.interval is None:
+        record.interval = elapsed
+    else:
+        record.interval = 0.8 * record.interval + 0.2 * elapsed
+    record.last_seen = now
+    record.events += 1
+    if fields != record.fields:
+        # Keep every field ever reported so all its configs can be cleared
+        fields = record.fields | fields
+        record.fields = field_sets.setdefault(fields, fields)
+
+
+def inventory_snapshot(now=None):
+    """Return the device inventory as a list of dicts, most recently seen
+    first."""
+    if now is None:
+        now = time.time()
+    snapshot = []
+    for device_id, record in device_inventory.items():
+        snapshot.append(
+            {
+                "id": device_id,
+                "model": record.model,
+                "fields": sorted(record.fields),
+                "first_seen": record.first_seen,
+                "last_seen": record.last_seen,
+                "silent_for": now - record.last_seen,
+                "events": record.events,
+                "events_per_hour": (
+                    3600 / record.interval if record.interval else None
+                ),
+            }
+        )
+    snapshot.sort(key=lambda d: d["last_seen"], reverse=True)
+    return snapshot
+
+
+def write_inventory(settings):
+    """Write the inventory snapshot to RTL_433_INVENTORY_FILE as JSON."""
+    tmp_file = f"{settings.rtl_433_inventory_file}.tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(inventory_snapshot(), f)
+        os.replace(tmp_file, settings.rtl_433_inventory_file)
+    except OSError as e:
+        logger.error(f"Inventory: Failed to write snapshot: {e}")
+
+
+def collect_stale_devices(client, settings):
+    """Clear the discovery configs of devices not heard from for longer than
+    RTL_433_STALE_AFTER and drop them from the inventory.
+
+    Configs are cleared by publishing a retained empty payload, which removes
+    the entities from Home Assistant and the retained config from the broker.
+    A device is only dropped once all its clears have been acknowledged, until
+    then it is checked again on each pass.  Stops at the first failed publish,
+    the rest wait for the next pass."""
+    cutoff = time.time() - settings.rtl_433_stale_after
+    stale = [
+        device_id
+        for device_id, record in device_inventory.items()
+        if record.last_seen < cutoff
+    ]
+
+    cleared = 0
+    for device_id in stale:
+        record = device_inventory[device_id]
+
+        if device_id in pending_clears:
+            connects, infos = pending_clears[device_id]
+            if all(info.is_published() for info in infos):
+                del pending_clears[device_id]
+                del device_inventory[device_id]
+                cleared += 1
+                logger.debug(f"GC: Cleared {device_id} ({record.model})")
+                continue
+            # The client still holds these, except QoS 0 ones queued when the
+            # connection dropped, which are lost and sent again
+            if settings.ha_discovery_qos > 0:
+                continue
+            if connects == connection_stats["connects"]:
+                continue
+
+        topics = device_config_topics(settings, device_id, record)
+        infos = []
+        for discovery_topic in topics:
+            info = client.publish(
+                discovery_topic, "", qos=settings.ha_discovery_qos, retain=True
+            )
+            queued = info.rc == mqtt.MQTT_ERR_NO_CONN and settings.ha_discovery_qos > 0
+            if info.rc != 0 and not queued:
+                logger.error(
+                    f"MQTT: Error clearing discovery, result: {info.rc}, topic: {discovery_topic}"
+                )
+                logger.info(f"GC: Cleared {cleared} of {len(stale)} stale devices")
+                return cleared
+            infos.append(info)
+
+        pending_clears[device_id] = (connection_stats["connects"], infos)
+        # Anything announced for the device from here on goes out after the
+        # clears, so it is announced afresh if it is heard from again
+        forget_discovery(topics)
+
+    if stale:
+        logger.info(
+            f"GC: Cleared {cleared} stale devices, {len(pending_clears)} awaiting acknowledgement"
+        )
+    return cleared
+
+
+def device_config_topics(settings, device_id, record):
+    """Return every discovery topic announced for a device in the inventory."""
+    return [
+        config_topic(settings, m, device_id)
+        for key in record.fields
+        for m in settings.mappings[key]
+    ]
+
+
+def forget_discovery(topics):
+    """Drop all discovery state for topics, they are announced afresh if the
+    device is heard from again."""
+    for discovery_topic in topics:
+        discovery_timeouts.pop(discovery_topic, None)
+        publish_failures.pop(discovery_topic, None)
+        pending_mid = pending_topics.pop(discovery_topic, None)
+        if pending_mid is not None:
+            del pending_publishes[pending_mid]
+
+
+def forget_silent_devices(settings):
+    """Drop devices silent for longer than RTL_433_FORGET_AFTER from the
+    inventory and discovery state, leaving their configs in place.
+
+    Keeps memory bounded when clearing is off, otherwise every passing car's
+    TPMS sensors would be remembered forever.  Devices still waiting on
+    RTL_433_STALE_AFTER to have their configs cleared are kept."""
+    if settings.rtl_433_forget_after <= 0:
+        return 0
+
+    cutoff = time.time() - max(
+        settings.rtl_433_forget_after, settings.rtl_433_stale_after
+    )
+    silent = [
+        device_id
+        for device_id, record in device_inventory.items()
+        if record.last_seen < cutoff and device_id not in pending_clears
+    ]
+    for device_id in silent:
+        record = device_inventory.pop(device_id)
+        forget_discovery(device_config_topics(settings, device_id, record))
+
+    # Drop field sets no remaining device refers to
+    in_use = {record.fields for record in device_inventory.values()}
+    for fields in [fields for fields in field_sets if fields not in in_use]:
+        del field_sets[fields]
+
+    if silent:
+        logger.info(f"Inventory: Forgot {len(silent)} silent devices")
+    return len(silent)
+
+
+def log_report(limit=20):
+    """Log the busiest models and the fields seen without a mapping."""
+    busiest = sorted(model_stats.items(), key=lambda i: i[1]["events"], reverse=True)
+    logger.info(f"Report: {len(model_stats)} models, connection: {connection_stats}")
+    logger.info(
+        f"Report: {len(device_inventory)} devices, {len(field_sets)} distinct field sets"
+    )
+    for model, stats in busiest[:limit]:
+        # Average milliseconds per sampled event for each stage
+        stages = ", ".join(
+            f"{stage}: {elapsed * 1000 / stats['sampled']:.3f}ms"
+            for stage, elapsed in sorted(stats["time"].items())
+        )
+        logger.info(
+            f"Report: {model}: events: {stats['events']}, published: {stats['published']}, skipped: {stats['skipped']}"
+            + (f", {stages}" if stages else "")
+        )
+    for model, fields in sorted(unmapped_fields.items())[:limit]:
+        logger.info(f"Unmapped {model}: {fields}")
+
+
+def request_report(signum, frame):
+    # Only flag it here, logging from inside a signal handler can deadlock
+    report_state["requested"] = True
+
+
+def resync_discovery(settings):
+    """Bring discovery deadlines forward after a reconnect, per RTL_433_RESYNC.
+
+    Devices are re-announced through publish_config() as their events arrive,
+    so the usual per topic rate limiting still applies."""
+    now = time.time()
+
+    # The client resends queued QoS 1/2 publishes after reconnecting, but QoS
+    # 0 ones still queued when the connection dropped are lost.  Those are
+    # rescheduled with everything else.
+    if settings.ha_discovery_qos == 0:
+        for discovery_topic in pending_topics:
+            discovery_timeouts[discovery_topic] = now
+        pending_publishes.clear()
+        pending_topics.clear()
+
+    if settings.rtl_433_resync == "none":
+        return
+
+    for discovery_topic in discovery_timeouts:
+        if settings.rtl_433_resync == "all":
+            discovery_timeouts[discovery_topic] = now
+        else:
+            discovery_timeouts[discovery_topic] = now + random.uniform(
+                0, settings.rtl_433_resync_window
+            )
+
+    logger.info(
+        f"Resync: {len(discovery_timeouts)} discovery topics, policy: {settings.rtl_433_resync}"
+    )
+
+
+def subscribe(client, settings):
+    connection_state["subscribe_at"] = None
+    logger.info(f"MQTT: Subscribe: {settings.rtl_433_mqtt_topic}")
+    (result, mid) = client.subscribe(settings.rtl_433_mqtt_topic)
+    if result != 0:
+        subscribe_failed(settings, f"result: {result}")
+
+
+def subscribe_failed(settings, reason):
+    connection_stats["subscribe_failures"] += 1
+    connection_state["subscribe_attempts"] += 1
+    delay = jitter(
+        backoff(
+            settings.mqtt_reconnect_min,
+            settings.mqtt_reconnect_max,
+            connection_state["subscribe_attempts"],
+        )
+    )
+    connection_state["subscribe_at"] = time.monotonic() + delay
+    logger.error(f"MQTT: Subscribe failed, {reason}, retry in: {delay:.1f}s")
+
+
+def connect(client, settings, timeout=None):
+    """Connect to the broker, backing off with jitter between failed attempts.
+
+    Retries forever unless a timeout in seconds is given, after which a
+    ConnectionError is raised."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        attempts = connection_state["attempts"]
+        if attempts > 0:
+            delay = jitter(
+                backoff(
+                    settings.mqtt_reconnect_min, settings.mqtt_reconnect_max, attempts
+                )
+            )
+            if deadline is not None:
+                if time.monotonic() + delay > deadline:
+                    raise ConnectionError(
+                        f"MQTT: Could not connect to {settings.mqtt_broker}:{settings.mqtt_port} within {timeout}s"
+                    )
+            logger.info(f"MQTT: Reconnect attempt {attempts} in {delay:.1f}s")
+            time.sleep(delay)
+        connection_state["attempts"] += 1
+
+        logger.info(
+            f"MQTT: Connect to {settings.mqtt_broker}:{settings.mqtt_port} ({settings.mqtt_client_id})"
+        )
+        try:
+            client.connect(settings.mqtt_broker, settings.mqtt_port, 60)
+            return
+        except OSError as e:
+            connection_stats["connect_failures"] += 1
+            logger.error(f"MQTT: Connect failed: {e}")
+
+
+def maintain_connection(client, settings):
+    """Run the network loop, reconnecting whenever the connection drops.
+
+    Used in place of loop_forever() so reconnects get jittered backoff and
+    there is a place for periodic housekeeping."""
+    while True:
+        rc = client.loop(timeout=1.0)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            connect(client, settings)
+            continue
+
+        subscribe_at = connection_state["subscribe_at"]
+        if subscribe_at is not None and time.monotonic() >= subscribe_at:
+            subscribe(client, settings)
+
+        report_due = report_state["next_at"] is not None and (
+            time.monotonic() >= report_state["next_at"]
+        )
+        if report_state["requested"] or report_due:
+            report_state["requested"] = False
+            if settings.rtl_433_report_interval > 0:
+                report_state["next_at"] = (
+                    time.monotonic() + settings.rtl_433_report_interval
+                )
+            log_report()
+            if settings.rtl_433_inventory_file:
+                write_inventory(settings)
+
+        if time.monotonic() >= report_state["gc_at"]:
+            report_state["gc_at"] = time.monotonic() + settings.rtl_433_gc_interval
+            if settings.rtl_433_stale_after > 0:
+                collect_stale_devices(client, settings)
+            forget_silent_devices(settings)
+
+
+def log_startup():
+    """Report the time from run() to the first connection to the broker,
+    including any reconnect backoff, and the peak memory use so far."""
+    if connection_state["started_at"] is None:
+        return
+    elapsed_ms = (time.monotonic() - connection_state["started_at"]) * 1000
+    # ru_maxrss is reported in kilobytes on Linux
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    logger.info(
+        f"Startup: connected {elapsed_ms:.0f} ms after start, max RSS: {max_rss_mb:.1f} MiB"
+    )
+
+
+def create_client(settings):
+    """Return an MQTT client configured for publishing discovery messages."""
+    if not settings.mqtt_broker:
         raise Exception("MQTT_BROKER must be defined.")
 
-    client = mqtt.Client(MQTT_CLIENT_ID)
+    client = mqtt.Client(settings.mqtt_client_id, userdata=settings)
+
+    if settings.mqtt_username is not None and settings.mqtt_password is not None:
+        logger.info(
+            f"MQTT: Authentication enabled, connect as: {settings.mqtt_username}"
+        )
+        client.username_pw_set(settings.mqtt_username, settings.mqtt_password)
 
-    if MQTT_USERNAME is not None and MQTT_PASSWORD is not None:
-        logger.info(f"MQTT: Authentication enabled, connect as: {MQTT_USERNAME}")
-        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    client.on_publish = on_publish
+    client.on_disconnect = on_disconnect
 
-    client.on_connect = on_connect
-    client.on_message = on_message
+    client.max_inflight_messages_set(settings.mqtt_max_inflight)
+    client.max_queued_messages_set(settings.mqtt_max_queued)
 
-    if MQTT_PORT == 8883:
+    if settings.mqtt_port == 8883:
         logger.info("MQTT: Enable TLS.")
         client.tls_set(certifi.where())
 
-    logger.info(f"MQTT: Connect to {MQTT_BROKER}:{MQTT_PORT} ({MQTT_CLIENT_ID})")
-    client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    return client
 
-    if len(RTL_433_IDS) > 0:
-        logger.info(f"Only discovering devices with ids: {RTL_433_IDS}")
+
+def run():
+    connection_state["started_at"] = time.monotonic()
+    settings = Settings.from_env()
+    logger.setLevel(settings.log_level)
+
+    client = create_client(settings)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_subscribe = on_subscribe
+
+    # Before connecting, which can retry for a long time while the broker is
+    # down, otherwise a report request would kill the process
+    signal.signal(signal.SIGUSR1, request_report)
+
+    connect(client, settings)
+
+    if settings.rtl_433_ids:
+        logger.info(f"Only discovering devices with ids: {settings.rtl_433_ids}")
     else:
         logger.info("Discovering all devices.")
 
-    logger.info(f"RTL_433_RETAIN: {RTL_433_RETAIN}")
+    logger.info(f"RTL_433_RETAIN: {settings.rtl_433_retain}")
+    logger.info(f"RTL_433_ABBREVIATE: {settings.rtl_433_abbreviate}")
+    logger.info(f"HA_DISCOVERY_QOS: {settings.ha_discovery_qos}")
+    logger.info(f"RTL_433_RESYNC: {settings.rtl_433_resync}")
+
+    if settings.rtl_433_report_interval > 0:
+        report_state["next_at"] = time.monotonic() + settings.rtl_433_report_interval
+    report_state["gc_at"] = time.monotonic() + settings.rtl_433_gc_interval
+
+    maintain_connection(client, settings)
+
+
+class DiscoveryFileWriter:
+    """Stands in for the MQTT client, writing each discovery message to a file
+    as a JSON line of topic, payload and retain flag."""
+
+    def __init__(self, settings, out):
+        self.settings = settings
+        self.out = out
+        self.mid = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.mid += 1
+        self.out.write(
+            json.dumps(
+                {"topic": topic, "payload": payload, "retain": retain},
+                ensure_ascii=False,
+            )
+            + "\n"
+        )
+        # Written is as good as acknowledged
+        on_publish(self, self.settings, self.mid)
+        return (mqtt.MQTT_ERR_SUCCESS, self.mid)
+
+
+def read_events(log_file):
+    """Yield decoded events from an rtl_433 JSON log, one object per line."""
+    f = open(log_file, encoding="utf-8") if log_file != "-" else sys.stdin
+    errors = 0
+    try:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                errors += 1
+                logger.debug(f"Replay: JSON decode error: {line}")
+                continue
+            if isinstance(data, dict):
+                yield data
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    if errors:
+        logger.warning(f"Replay: Skipped {errors} lines that were not JSON")
+
+
+def wait_for(client, condition, timeout):
+    """Run the network loop until condition() is true or timeout passes."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        client.loop(timeout=0.1)
+    return condition()
+
+
+def replay(settings, log_file, output=None, topic_prefix="rtl_433", timeout=30):
+    """Announce every device found in an rtl_433 JSON log, either writing the
+    discovery messages to output or publishing them to the broker.
+
+    Returns the number of discovery messages the broker did not acknowledge,
+    raises ConnectionError if the broker can't be reached within timeout."""
+    start = time.monotonic()
+
+    if output is not None:
+        out = open(output, "w", encoding="utf-8") if output != "-" else sys.stdout
+        client = DiscoveryFileWriter(settings, out)
+    else:
+        client = create_client(settings)
+        connect(client, settings, timeout)
+        if not wait_for(client, client.is_connected, timeout):
+            raise ConnectionError(f"MQTT: Not connected after {timeout}s")
 
-    client.loop_forever()
+    events = 0
+    try:
+        for data in read_events(log_file):
+            bridge_event_to_hass(client, settings, topic_prefix, data)
+            events += 1
+            if output is None:
+                # Service acks and keepalives as we go, and let the broker
+                # catch up rather than overflowing the client's outgoing queue
+                if events % 100 == 0:
+                    client.loop(timeout=0)
+                wait_for(
+                    client,
+                    lambda: len(pending_publishes) < settings.mqtt_max_inflight,
+                    timeout,
+                )
+    finally:
+        if output is not None and out is not sys.stdout:
+            out.close()
+
+    unacknowledged = 0
+    if output is None:
+        if not wait_for(client, lambda: not pending_publishes, timeout):
+            unacknowledged = len(pending_publishes)
+            logger.error(
+                f"Replay: {unacknowledged} discovery messages not acknowledged"
+            )
+        client.disconnect()
+
+    logger.info(
+        f"Replay: {events} events, {len(discovery_timeouts)} discovery topics in {time.monotonic() - start:.1f}s"
+    )
+    log_report()
+    return unacknowledged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Publish Home Assistant MQTT discovery for rtl_433 devices."
+    )
+    commands = parser.add_subparsers(dest="command")
+    replay_parser = commands.add_parser(
+        "replay",
+        help="Announce the devices in a captured rtl_433 JSON log, then exit.",
+    )
+    replay_parser.add_argument(
+        "log_file", help="rtl_433 JSON log (ie: rtl_433 -F json), - for stdin."
+    )
+    target = replay_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument(
+        "--output",
+        help="Write discovery messages to this file as JSON lines, - for stdout.",
+    )
+    target.add_argument(
+        "--publish",
+        action="store_true",
+        help="Publish discovery messages to the configured broker.",
+    )
+    replay_parser.add_argument(
+        "--retain",
+        action="store_true",
+        help="Retain the discovery messages, overrides RTL_433_RETAIN.",
+    )
+    replay_parser.add_argument(
+        "--topic-prefix",
+        default="rtl_433",
+        help="The topic prefix rtl_433 publishes device data under.",
+    )
+    replay_parser.add_argument(
+        "--timeout",
+        type=int,
+        default=30,
+        help="Seconds to wait for the broker to connect and acknowledge.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command != "replay":
+        run()
+        return
+
+    settings = Settings.from_env()
+    logger.setLevel(settings.log_level)
+    if args.retain:
+        settings = replace(settings, rtl_433_retain=True)
+    try:
+        unacknowledged = replay(
+            settings, args.log_file, args.output, args.topic_prefix, args.timeout
+        )
+    except ConnectionError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    if unacknowledged:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    run()
+    main()
@@ -0,0 +1,490 @@
+import json
+import os
+import sys
+
+import paho.mqtt.client as mqtt
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "container"))
+
+import rtl_433_mqtt_ha_discovery as discovery
+
+EVENT = {"model": "Acurite-Tower", "id": 1234, "channel": "A", "temperature_C": 20.1}
+TOPIC = "homeassistant/sensor/Acurite-Tower-A-1234/Acurite-Tower-A-1234-T/config"
+
+
+class FakeClient:
+    """Records publishes, returning a result code set by the test."""
+
+    def __init__(self):
+        self.published = []
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+        self.mid = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.mid += 1
+        self.published.append((topic, payload, qos, retain))
+        info = mqtt.MQTTMessageInfo(self.mid)
+        info.rc = self.rc
+        return info
+
+    def topics(self):
+        return [topic for topic, _, _, _ in self.published]
+
+
+@pytest.fixture(autouse=True)
+def reset_state():
+    discovery.discovery_timeouts.clear()
+    discovery.pending_publishes.clear()
+    discovery.pending_topics.clear()
+    discovery.early_acks.clear()
+    discovery.publish_failures.clear()
+    discovery.model_stats.clear()
+    discovery.device_inventory.clear()
+    discovery.field_sets.clear()
+    discovery.pending_clears.clear()
+    discovery.unmapped_fields.clear()
+    for key in discovery.connection_stats:
+        discovery.connection_stats[key] = 0
+    discovery.connection_state["attempts"] = 0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(discovery.time, "time", lambda: now[0])
+    return now
+
+
+def temperature_mapping(settings):
+    return settings.mappings["temperature_C"][0]
+
+
+def publish(client, settings):
+    return discovery.publish_config(
+        client,
+        settings,
+        "rtl_433/devices/Acurite-Tower/A/1234/temperature_C",
+        "Acurite-Tower",
+        "Acurite-Tower-A-1234",
+        temperature_mapping(settings),
+        "temperature_C",
+    )
+
+
+def test_unacknowledged_publish_is_not_repeated(clock):
+    settings = discovery.Settings(ha_discovery_qos=1)
+    client = FakeClient()
+
+    assert publish(client, settings)
+    clock[0] += settings.rtl_433_retry_min + 1
+    assert not publish(client, settings)
+
+    assert client.topics() == [TOPIC]
+    assert discovery.pending_topics == {TOPIC: 1}
+
+
+def test_ack_commits_interval(clock):
+    settings = discovery.Settings(ha_discovery_qos=1)
+    client = FakeClient()
+
+    publish(client, settings)
+    clock[0] += 30
+    discovery.on_publish(client, settings, 1)
+
+    assert discovery.pending_publishes == {}
+    assert discovery.pending_topics == {}
+    assert discovery.early_acks == set()
+    assert discovery.discovery_timeouts[TOPIC] == clock[0] + settings.rtl_433_interval
+
+    clock[0] += settings.rtl_433_interval - 1
+    assert not publish(client, settings)
+    clock[0] += 2
+    assert publish(client, settings)
+    assert client.topics() == [TOPIC, TOPIC]
+
+
+def test_ack_during_publish(clock):
+    settings = discovery.Settings()
+    client = FakeClient()
+    # Ack arrives before client.publish() has returned the mid
+    discovery.on_publish(client, settings, 1)
+
+    publish(client, settings)
+
+    assert discovery.pending_topics == {}
+    assert discovery.early_acks == set()
+    assert discovery.discovery_timeouts[TOPIC] == clock[0] + settings.rtl_433_interval
+
+
+def test_failed_publish_backs_off(clock):
+    settings = discovery.Settings(rtl_433_retry_min=5, rtl_433_retry_max=12)
+    client = FakeClient()
+    client.rc = mqtt.MQTT_ERR_QUEUE_SIZE
+
+    delays = []
+    for _ in range(4):
+        assert not publish(client, settings)
+        delays.append(discovery.discovery_timeouts[TOPIC] - clock[0])
+        assert not publish(client, settings)
+        clock[0] = discovery.discovery_timeouts[TOPIC]
+
+    assert delays == [5, 10, 12, 12]
+    assert len(client.published) == 4
+    assert discovery.pending_topics == {}
+
+    client.rc = mqtt.MQTT_ERR_SUCCESS
+    assert publish(client, settings)
+    discovery.on_publish(client, settings, client.mid)
+    assert TOPIC not in discovery.publish_failures
+
+
+def test_qos0_publish_while_disconnected_fails(clock):
+    settings = discovery.Settings(ha_discovery_qos=0)
+    client = FakeClient()
+    client.rc = mqtt.MQTT_ERR_NO_CONN
+
+    assert not publish(client, settings)
+    assert discovery.pending_topics == {}
+    assert discovery.publish_failures == {TOPIC: 1}
+
+
+def test_qos1_publish_while_disconnected_is_held(clock):
+    settings = discovery.Settings(ha_discovery_qos=1)
+    client = FakeClient()
+    client.rc = mqtt.MQTT_ERR_NO_CONN
+
+    assert publish(client, settings)
+    assert discovery.pending_topics == {TOPIC: 1}
+    assert discovery.publish_failures == {}
+
+
+def test_bridge_event_publishes_mapped_keys(clock):
+    settings = discovery.Settings()
+    client = FakeClient()
+
+    discovery.bridge_event_to_hass(client, settings, "rtl_433", EVENT)
+
+    assert TOPIC in client.topics()
+    assert len(client.published) == 2  # channel trigger and temperature
+
+
+def test_resync_keeps_qos1_pending(clock):
+    settings = discovery.Settings(ha_discovery_qos=1, rtl_433_resync="all")
+    client = FakeClient()
+
+    publish(client, settings)
+    discovery.resync_discovery(settings)
+
+    assert discovery.pending_topics == {TOPIC: 1}
+    assert not publish(client, settings)
+    discovery.on_publish(client, settings, 1)
+    assert discovery.discovery_timeouts[TOPIC] == clock[0] + settings.rtl_433_interval
+
+
+@pytest.mark.parametrize("policy", ["none", "all", "spread"])
+def test_resync_republishes_lost_qos0(clock, policy):
+    settings = discovery.Settings(
+        ha_discovery_qos=0, rtl_433_resync=policy, rtl_433_resync_window=10
+    )
+    client = FakeClient()
+
+    publish(client, settings)
+    discovery.resync_discovery(settings)
+
+    assert discovery.pending_topics == {}
+    assert clock[0] <= discovery.discovery_timeouts[TOPIC] <= clock[0] + 10
+    clock[0] += 10
+    assert publish(client, settings)
+    assert client.topics() == [TOPIC, TOPIC]
+
+
+def test_filtered_events_are_not_sampled(clock):
+    settings = discovery.Settings(rtl_433_ids=["1"], rtl_433_profile_sample=1.0)
+    client = FakeClient()
+
+    for device_id in range(1, 100):
+        discovery.bridge_event_to_hass(
+            client, settings, "rtl_433", dict(EVENT, id=device_id)
+        )
+
+    stats = discovery.model_stats["Acurite-Tower"]
+    assert stats["events"] == 99
+    assert stats["sampled"] == 1
+    assert "total" in stats["time"]
+
+
+def test_replay_connect_gives_up(monkeypatch):
+    now = [0.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    class UnreachableClient(FakeClient):
+        def connect(self, host, port, keepalive):
+            raise ConnectionRefusedError("refused")
+
+    monkeypatch.setattr(discovery.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(discovery.time, "sleep", sleep)
+    monkeypatch.setattr(discovery, "create_client", lambda s: UnreachableClient())
+
+    with pytest.raises(ConnectionError):
+        discovery.replay(discovery.Settings(), os.devnull, timeout=30)
+    assert now[0] <= 30
+
+
+def test_silent_devices_are_forgotten(clock):
+    settings = discovery.Settings(rtl_433_forget_after=3600)
+    client = FakeClient()
+
+    discovery.bridge_event_to_hass(client, settings, "rtl_433", EVENT)
+    clock[0] += 1800
+    tpms = {"model": "TPMS", "id": "abc", "pressure_kPa": 200}
+    discovery.bridge_event_to_hass(client, settings, "rtl_433", tpms)
+    clock[0] += 1801
+
+    assert discovery.forget_silent_devices(settings) == 1
+    assert list(discovery.device_inventory) == ["TPMS-abc"]
+    assert list(discovery.field_sets) == [frozenset(["pressure_kPa"])]
+    assert TOPIC not in discovery.discovery_timeouts
+    assert client.topics().count(TOPIC) == 1
+
+
+def clears(client):
+    return [(topic, qos) for topic, payload, qos, retain in client.published if retain]
+
+
+@pytest.mark.parametrize("qos", [0, 1])
+def test_stale_device_kept_until_clear_acknowledged(clock, qos):
+    settings = discovery.Settings(rtl_433_stale_after=60, ha_discovery_qos=qos)
+    client = FakeClient()
+
+    discovery.bridge_event_to_hass(client, settings, "rtl_433", EVENT)
+    announced = client.mid
+    client.published.clear()
+    clock[0] += 61
+
+    assert discovery.collect_stale_devices(client, settings) == 0
+    assert len(clears(client)) == 2
+    assert "Acurite-Tower-A-1234" in discovery.device_inventory
+    assert TOPIC not in discovery.pending_topics
+
+    # Not acknowledged yet, nothing is sent again
+    assert discovery.collect_stale_devices(client, settings) == 0
+    assert len(clears(client)) == 2
+
+    _, infos = discovery.pending_clears["Acurite-Tower-A-1234"]
+    for info in infos:
+        info._set_as_published()
+    assert discovery.collect_stale_devices(client, settings) == 1
+    assert discovery.device_inventory == {}
+    assert discovery.pending_clears == {}
+    assert client.mid == announced + 2
+
+
+def test_lost_qos0_clears_are_resent(clock):
+    settings = discovery.Settings(rtl_433_stale_after=60, ha_discovery_qos=0)
+    client = FakeClient()
+
+    discovery.bridge_event_to_hass(client, settings, "rtl_433", EVENT)
+    client.published.clear()
+    clock[0] += 61
+
+    discovery.collect_stale_devices(client, settings)
+    discovery.connection_stats["connects"] += 1
+    discovery.collect_stale_devices(client, settings)
+
+    assert len(clears(client)) == 4
+    assert "Acurite-Tower-A-1234" in discovery.device_inventory
+
+
+def test_device_heard_while_clearing_is_reannounced(clock):
+    settings = discovery.Settings(rtl_433_stale_after=60)
+    client = FakeClient()
+
+    discovery.bridge_event_to_hass(client, settings, "rtl_433", EVENT)
+    discovery.on_publish(client, settings, 1)
+    discovery.on_publish(client, settings, 2)
+    clock[0] += 61
+    discovery.collect_stale_devices(client, settings)
+    client.published.clear()
+
+    discovery.bridge_event_to_hass(client, settings, "rtl_433", EVENT)
+
+    assert discovery.pending_clears == {}
+    assert TOPIC in client.topics()
+    assert discovery.collect_stale_devices(client, settings) == 0
+    assert "Acurite-Tower-A-1234" in discovery.device_inventory
+
+
+def payloads(client):
+    return {topic: json.loads(payload) for topic, payload, _, _ in client.published}
+
+
+def assert_abbreviated(config):
+    assert not set(config) & set(discovery.ABBREVIATIONS)
+    assert not set(config["dev"]) & set(discovery.DEVICE_ABBREVIATIONS)
+
+
+def test_abbreviated_sensor_config(clock):
+    settings = discovery.Settings(rtl_433_abbreviate=True, rtl_433_expire_after=30)
+    client = FakeClient()
+
+    publish(client, settings)
+
+    topic, payload, _, _ = client.published[0]
+    assert topic == TOPIC
+    assert "°C" in payload
+    assert ": " not in payload
+    config = json.loads(payload)
+    assert_abbreviated(config)
+    assert config["stat_t"] == "rtl_433/devices/Acurite-Tower/A/1234/temperature_C"
+    assert config["uniq_id"] == "Acurite-Tower-A-1234-T"
+    assert config["unit_of_meas"] == "°C"
+    assert config["dev_cla"] == "temperature"
+    assert config["val_tpl"] == "{{ value|float|round(1) }}"
+    assert config["exp_aft"] == 30
+    assert config["dev"] == {
+        "ids": ["Acurite-Tower-A-1234"],
+        "name": "Acurite-Tower-A-1234",
+        "mdl": "Acurite-Tower",
+        "mf": "rtl_433",
+    }
+    assert "~" not in config
+
+
+def test_abbreviated_device_automation_config(clock):
+    settings = discovery.Settings(rtl_433_abbreviate=True)
+    client = FakeClient()
+
+    discovery.bridge_event_to_hass(
+        client, settings, "rtl_433", dict(EVENT, secret_knock=1)
+    )
+
+    knock = payloads(client)[
+        "homeassistant/device_automation/Acurite-Tower-A-1234/Acurite-Tower-A-1234-Secret-Knock/config"
+    ]
+    assert_abbreviated(knock)
+    assert knock["t"] == "rtl_433/devices/Acurite-Tower/A/1234/secret_knock"
+    assert knock["p"] == "mqtt"
+    assert knock["atype"] == "trigger"
+    assert knock["type"] == "button_triple_press"
+    assert knock["stype"] == "button_1"
+    assert knock["pl"] == 1
+
+
+def test_full_config_is_not_abbreviated(clock):
+    settings = discovery.Settings()
+    client = FakeClient()
+
+    publish(client, settings)
+
+    config = payloads(client)[TOPIC]
+    assert config["state_topic"] == "rtl_433/devices/Acurite-Tower/A/1234/temperature_C"
+    assert config["device"]["identifiers"] == ["Acurite-Tower-A-1234"]
+
+
+def test_settings_rejects_unknown_resync_policy():
+    with pytest.raises(Exception, match="RTL_433_RESYNC"):
+        discovery.Settings.from_env({"RTL_433_RESYNC": "sometimes"})
+    with pytest.raises(Exception, match="RTL_433_RESYNC"):
+        discovery.Settings(rtl_433_resync="sometimes")
+
+
+def test_report_tables_are_bounded(clock, monkeypatch):
+    monkeypatch.setattr(discovery, "MAX_REPORT_MODELS", 3)
+    monkeypatch.setattr(discovery, "MAX_REPORT_FIELDS", 2)
+    settings = discovery.Settings()
+    client = FakeClient()
+
+    for n in range(5):
+        event = {"model": f"Model-{n}", "id": n, "a": 1, "b": 2, "c": 3, "d": 4}
+        discovery.bridge_event_to_hass(client, settings, "rtl_433", event)
+
+    other = discovery.REPORT_OTHER
+    assert list(discovery.model_stats) == ["Model-0", "Model-1", "Model-2", other]
+    assert discovery.model_stats[other]["events"] == 2
+    assert discovery.model_stats[other]["skipped"] == 8
+    assert list(discovery.unmapped_fields) == ["Model-0", "Model-1", "Model-2", other]
+    assert discovery.unmapped_fields["Model-0"] == {"a": 1, "b": 1, other: 2}
+    assert discovery.unmapped_fields[other] == {"a": 2, "b": 2, other: 4}
+
+
+def test_log_report_sampled_and_unsampled(clock, caplog):
+    client = FakeClient()
+    discovery.bridge_event_to_hass(
+        client, discovery.Settings(rtl_433_profile_sample=1.0), "rtl_433", EVENT
+    )
+    discovery.bridge_event_to_hass(
+        client,
+        discovery.Settings(),
+        "rtl_433",
+        {"model": "TPMS", "id": "abc", "pressure_kPa": 200, "flags": 1},
+    )
+
+    with caplog.at_level("INFO", logger=discovery.logger.name):
+        discovery.log_report()
+
+    lines = [record.getMessage() for record in caplog.records]
+    sampled = next(line for line in lines if line.startswith("Report: Acurite-Tower"))
+    assert "total: " in sampled
+    unsampled = next(line for line in lines if line.startswith("Report: TPMS"))
+    assert unsampled.endswith("skipped: 1")
+    assert "Unmapped TPMS: {'flags': 1}" in lines
+
+
+def write_log(path, lines):
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return str(path)
+
+
+def test_replay_to_file_deduplicates(tmp_path):
+    tpms = {"model": "TPMS", "id": "abc", "pressure_kPa": 200}
+    log_file = write_log(
+        tmp_path / "rtl_433.json",
+        [json.dumps(EVENT)] * 3
+        + ["not json", "[1, 2]", "", json.dumps(tpms), json.dumps(EVENT)],
+    )
+    output = tmp_path / "discovery.json"
+
+    assert discovery.replay(discovery.Settings(), log_file, str(output)) == 0
+
+    lines = [json.loads(line) for line in output.read_text().splitlines()]
+    topics = [line["topic"] for line in lines]
+    assert len(topics) == len(set(topics)) == 3
+    assert TOPIC in topics
+    assert all(line["retain"] is False for line in lines)
+    assert json.loads(lines[topics.index(TOPIC)]["payload"])["unique_id"] == (
+        "Acurite-Tower-A-1234-T"
+    )
+    assert discovery.pending_publishes == {}
+    assert discovery.model_stats["Acurite-Tower"]["events"] == 4
+
+
+def test_replay_closes_output_on_error(tmp_path, monkeypatch):
+    tpms = {"model": "TPMS", "id": "abc", "pressure_kPa": 200}
+    log_file = write_log(
+        tmp_path / "rtl_433.json", [json.dumps(EVENT), json.dumps(tpms)]
+    )
+    output = tmp_path / "discovery.json"
+    bridge = discovery.bridge_event_to_hass
+
+    def failing_bridge(client, settings, topic_prefix, data):
+        if data["model"] == "TPMS":
+            raise RuntimeError("bridge failed")
+        bridge(client, settings, topic_prefix, data)
+
+    opened = []
+
+    def tracking_open(*args, **kwargs):
+        f = open(*args, **kwargs)
+        opened.append(f)
+        return f
+
+    monkeypatch.setattr(discovery, "bridge_event_to_hass", failing_bridge)
+    monkeypatch.setattr(discovery, "open", tracking_open, raising=False)
+
+    with pytest.raises(RuntimeError):
+        discovery.replay(discovery.Settings(), log_file, str(output))
+    assert opened and all(f.closed for f in opened)
+    assert len(output.read_text().splitlines()) == 2